@@ -1,12 +1,25 @@
+import math
 import numpy as np
 import geometry
+from functools import lru_cache
+from itertools import islice
 from torchmeta.modules import (MetaModule, MetaSequential)
 from collections import OrderedDict
 
 import torch
 from torch import nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 import tinycudann as tcnn
 
+try:
+    # A Python-only apex build imports fine but lacks the CUDA extension, so probe for it explicitly.
+    import fused_layer_norm_cuda
+    from apex.normalization.fused_layer_norm import fused_layer_norm, fused_layer_norm_affine
+    has_fused_layer_norm = True
+except ImportError:
+    has_fused_layer_norm = False
+
 
 def init_weights_normal(m):
     if type(m) == BatchLinear or type(m) == nn.Linear:
@@ -21,7 +34,33 @@ def first_layer_sine_init(m):
             # See paper sec. 3.2, final paragraph, and supplement Sec. 1.5 for discussion of factor 30
             m.weight.uniform_(-1 / num_input, 1 / num_input)
 
+
+@torch.jit.script
+def sine_activation(intermed: torch.Tensor, omega_0: float):
+    # Scripted so the fuser emits scale + sin as a single elementwise kernel.
+    return torch.sin(omega_0 * intermed)
+
+
+@torch.jit.script
+def sine_activation_film(intermed: torch.Tensor, gamma: torch.Tensor, beta: torch.Tensor, omega_0: float):
+    return torch.sin(gamma * omega_0 * intermed + beta)
+
+def is_autocast_enabled():
+    return torch.is_autocast_enabled() or torch.is_autocast_cpu_enabled()
+
+def output_layer_forward(layer, x, params):
+    '''Runs the output layer of an MLP, in full precision if autocast is on.'''
+    if not is_autocast_enabled():
+        return layer(x, params=params)
+    with torch.autocast(device_type=x.device.type, enabled=False):
+        return layer(x.float(), params=params)
+
 def get_encoding_config(input_encoding, n_dims_to_encode=-1):
+    # A fresh dict per call, so callers can't mutate the cached config.
+    return dict(_encoding_config_items(input_encoding, n_dims_to_encode))
+
+@lru_cache(maxsize=None)
+def _encoding_config_items(input_encoding, n_dims_to_encode):
     config = {} if n_dims_to_encode <= 0 else { "n_dims_to_encode": n_dims_to_encode }
     if input_encoding == 'identity':
         config["otype"] = "Identity"
@@ -36,7 +75,21 @@ def get_encoding_config(input_encoding, n_dims_to_encode=-1):
         config["base_resolution"] = 16
         config["per_level_scale"] = 2.0
 
-    return config
+    return tuple(config.items())
+
+def get_layer_subdicts(params, num_layers):
+    '''Splits the params of a module with a sequential `net` into one subdict per layer in a single pass, instead
+    of filtering the full dict once per layer via get_subdict.'''
+    if params is None:
+        return [None] * num_layers
+
+    subdicts = [OrderedDict() for _ in range(num_layers)]
+    for name, param in params.items():
+        # Like get_subdict, keys outside of `net` are ignored.
+        if name.startswith('net.'):
+            idx, sub_name = name[len('net.'):].split('.', 1)
+            subdicts[int(idx)][sub_name] = param
+    return [subdict or None for subdict in subdicts]
 
 class BatchLinear(nn.Linear, MetaModule):
     '''A linear meta-layer that can deal with batched weight matrices and biases, as for instance output by a
@@ -45,25 +98,47 @@ class BatchLinear(nn.Linear, MetaModule):
 
     def forward(self, input, params=None):
         if params is None:
-            params = OrderedDict(self.named_parameters())
+            weight, bias = self.weight, self.bias
+        else:
+            weight, bias = params['weight'], params.get('bias', None)
 
-        bias = params.get('bias', None)
-        weight = params['weight']
+        if weight.dim() == 2:
+            # Shared weights: addmm applies the bias in the GEMM epilogue.
+            return F.linear(input, weight, bias)
 
-        output = input.matmul(weight.permute(*[i for i in range(len(weight.shape) - 2)], -1, -2))
+        weight_t = weight.transpose(-1, -2)
+        if bias is None:
+            return input.matmul(weight_t)
+
+        if input.dim() == 3:
+            # Hypernetwork path: one batched GEMM with the bias add in the epilogue.
+            return torch.baddbmm(bias.unsqueeze(-2), input, weight_t)
+
+        output = input.matmul(weight_t)
         output += bias.unsqueeze(-2)
         return output
 
 
+class LayerNorm(nn.LayerNorm):
+    '''nn.LayerNorm that runs apex's fused kernel when its CUDA extension is installed. Under autocast it falls back
+    to nn.LayerNorm, which autocast keeps in FP32 (apex would run it in reduced precision).'''
+    def forward(self, input):
+        if not has_fused_layer_norm or not input.is_cuda or is_autocast_enabled():
+            return super().forward(input)
+        if self.elementwise_affine:
+            return fused_layer_norm_affine(input, self.weight, self.bias, self.normalized_shape, self.eps)
+        return fused_layer_norm(input, self.normalized_shape, self.eps)
+
+
 class FCLayer(MetaModule):
     def __init__(self, in_features, out_features, nonlinearity='relu', norm=None):
         super().__init__()
         self.net = [BatchLinear(in_features, out_features)]
 
         if norm == 'layernorm':
-            self.net.append(nn.LayerNorm([out_features], elementwise_affine=True),)
+            self.net.append(LayerNorm([out_features], elementwise_affine=True),)
         elif norm == 'layernorm_na':
-            self.net.append(nn.LayerNorm([out_features], elementwise_affine=False),)
+            self.net.append(LayerNorm([out_features], elementwise_affine=False),)
 
         if nonlinearity == 'relu':
             self.net.append(nn.ReLU(inplace=True))
@@ -103,13 +178,27 @@ class FCBlock(MetaModule):
         self.net.apply(init_weights_normal)
 
     def forward(self, input, params=None):
-        return self.net(input, params=self.get_subdict(params, 'net'))
+        x = input
+
+        layer_subdicts = get_layer_subdicts(params, len(self.net))
+        # islice rather than self.net[:-1], slicing a module container builds a new module on every call.
+        for layer, layer_params in zip(islice(self.net, len(self.net) - 1), layer_subdicts):
+            x = layer(x, params=layer_params)
+
+        x = output_layer_forward(self.net[-1], x, layer_subdicts[-1])
+
+        return x
 
 
 class SineLayer(MetaModule):
-    def __init__(self, in_features, out_features, bias=True, is_first=False, omega_0=30):
+    def __init__(self, in_features, out_features, bias=True, is_first=False, omega_0=30, checkpoint_activations=False):
         super().__init__()
         self.omega_0 = float(omega_0)
+        self.checkpoint_activations = checkpoint_activations
+        # omega_0 that has been folded into the linear layer by fuse_omega(). Stored with the weights so a fused
+        # checkpoint loads correctly, and mirrored as a float to avoid a device sync per forward.
+        self.register_buffer('folded_omega_0', torch.ones(()))
+        self._folded_omega_0 = 1.
 
         self.is_first = is_first
 
@@ -117,60 +206,145 @@ class SineLayer(MetaModule):
         self.linear = BatchLinear(in_features, out_features, bias=bias)
         self.init_weights()
 
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _siren_bound(in_features, omega_0):
+        return float(np.sqrt(6 / in_features) / omega_0)
+
     def init_weights(self):
         with torch.no_grad():
             if self.is_first:
                 self.linear.weight.uniform_(-1 / self.in_features,
                                             1 / self.in_features)
             else:
-                self.linear.weight.uniform_(-np.sqrt(6 / self.in_features) / self.omega_0,
-                                            np.sqrt(6 / self.in_features) / self.omega_0)
+                bound = self._siren_bound(self.in_features, self.omega_0)
+                self.linear.weight.uniform_(-bound, bound)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints from before fuse_omega() have no folded factor.
+        state_dict.setdefault(prefix + 'folded_omega_0', torch.ones(()))
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+        self._folded_omega_0 = float(self.folded_omega_0)
+
+    @property
+    def activation_omega_0(self):
+        return self.omega_0 / self._folded_omega_0
+
+    def fuse_omega(self):
+        '''Folds omega_0 into the linear weight and bias, saving one elementwise multiply per forward.
+        Inference only: call after load_state_dict and model.eval(). Params passed to forward() must then be in fused
+        form too, Siren.forward rescales hypernetwork-predicted params accordingly.'''
+        if self.training:
+            raise RuntimeError('fuse_omega() is for inference only, call eval() first.')
+        if self._folded_omega_0 != 1.:
+            return
+
+        with torch.no_grad():
+            self.linear.weight.mul_(self.omega_0)
+            if self.linear.bias is not None:
+                self.linear.bias.mul_(self.omega_0)
+            self.folded_omega_0.fill_(self.omega_0)
+        self._folded_omega_0 = self.omega_0
 
     def forward_with_film(self, input, gamma, beta):
         intermed = self.linear(input)
-        return torch.sin(gamma * self.omega_0 * intermed + beta)
+        return sine_activation_film(intermed, gamma, beta, self.activation_omega_0)
+
+    def _forward(self, input, linear_params, scripted=True):
+        intermed = self.linear(input, params=linear_params)
+        if is_autocast_enabled():
+            # SIREN is sensitive to omega_0 scaling, keep the activation in full precision.
+            intermed = intermed.float()
+        omega_0 = self.activation_omega_0
+        if omega_0 == 1.:
+            return torch.sin(intermed)
+        if not scripted:
+            return torch.sin(omega_0 * intermed)
+        return sine_activation(intermed, omega_0)
 
     def forward(self, input, params=None):
-        intermed = self.linear(input, params=self.get_subdict(params, 'linear'))
-        return torch.sin(self.omega_0 * intermed)
+        if self.training and self._folded_omega_0 != 1.:
+            raise RuntimeError('SineLayer has omega_0 fused into its weights and cannot be trained.')
+
+        linear_params = self.get_subdict(params, 'linear')
+        # torch 1.13's checkpoint recomputes under float16 autocast regardless of the forward dtype, so it is
+        # skipped under autocast.
+        if self.checkpoint_activations and self.training and torch.is_grad_enabled() and not is_autocast_enabled():
+            # Recompute the pre-activation in backward instead of keeping it alive for cos(). The eager sine is used
+            # here since the scripted one may run a different graph on recompute than on the original forward.
+            return checkpoint(self._forward, input, linear_params, False, use_reentrant=False, preserve_rng_state=False)
+        return self._forward(input, linear_params)
 
 
 class Siren(MetaModule):
     def __init__(self, in_features, hidden_features, hidden_layers, out_features, outermost_linear=False,
-                 first_omega_0=30, hidden_omega_0=30., special_first=True):
+                 first_omega_0=30, hidden_omega_0=30., special_first=True, checkpoint_activations=False):
         super().__init__()
         self.hidden_omega_0 = hidden_omega_0
+        # Number of points per chunk for inference, sized so a chunk's hidden activations stay cache-resident.
+        self.inference_chunk_size = max(2**12, 2**20 // hidden_features)
 
         layer = SineLayer
 
         self.net = []
         self.net.append(layer(in_features, hidden_features,
-                              is_first=special_first, omega_0=first_omega_0))
+                              is_first=special_first, omega_0=first_omega_0,
+                              checkpoint_activations=checkpoint_activations))
 
         for i in range(hidden_layers):
             self.net.append(layer(hidden_features, hidden_features,
-                                  is_first=False, omega_0=hidden_omega_0))
+                                  is_first=False, omega_0=hidden_omega_0,
+                                  checkpoint_activations=checkpoint_activations))
 
         if outermost_linear:
             final_linear = BatchLinear(hidden_features, out_features)
 
             with torch.no_grad():
-                final_linear.weight.uniform_(-np.sqrt(6 / hidden_features) / 30.,
-                                             np.sqrt(6 / hidden_features) / 30.)
+                bound = SineLayer._siren_bound(hidden_features, 30.)
+                final_linear.weight.uniform_(-bound, bound)
             self.net.append(final_linear)
         else:
-            self.net.append(layer(hidden_features, out_features, is_first=False, omega_0=hidden_omega_0))
+            self.net.append(layer(hidden_features, out_features, is_first=False, omega_0=hidden_omega_0,
+                                  checkpoint_activations=checkpoint_activations))
 
         self.net = nn.ModuleList(self.net)
 
+    def fold_omega_into_params(self, layer_subdicts):
+        '''Rescales unfused (e.g. hypernetwork-predicted) params once per forward for layers fused by fuse_omega().'''
+        return [OrderedDict((name, param * layer._folded_omega_0) for name, param in layer_params.items())
+                if layer_params is not None and isinstance(layer, SineLayer) and layer._folded_omega_0 != 1.
+                else layer_params
+                for layer, layer_params in zip(self.net, layer_subdicts)]
+
     def forward(self, coords, params=None):
+        layer_subdicts = self.fold_omega_into_params(get_layer_subdicts(params, len(self.net)))
+
+        # Chunking only pays off when all points share the weights, per-sample hypernetwork weights would be
+        # re-read for every chunk.
+        shared_weights = params is None or all(param.dim() <= 2 for param in params.values())
+        if shared_weights and not torch.is_grad_enabled() and coords.shape[:-1].numel() > self.inference_chunk_size:
+            flat_coords = coords.reshape(-1, coords.shape[-1])
+            out = torch.cat([self.forward_chunk(chunk, layer_subdicts)
+                             for chunk in flat_coords.split(self.inference_chunk_size)])
+            return out.view(*coords.shape[:-1], -1)
+        return self.forward_chunk(coords, layer_subdicts)
+
+    def forward_chunk(self, coords, layer_subdicts):
         x = coords
 
-        for i, layer in enumerate(self.net):
-            x = layer(x, params=self.get_subdict(params, f'net.{i}'))
+        # islice rather than self.net[:-1], slicing a module container builds a new module on every call.
+        for layer, layer_params in zip(islice(self.net, len(self.net) - 1), layer_subdicts):
+            x = layer(x, params=layer_params)
+
+        x = output_layer_forward(self.net[-1], x, layer_subdicts[-1])
 
         return x
 
+    def fuse_omega(self):
+        for layer in self.net:
+            if isinstance(layer, SineLayer):
+                layer.fuse_omega()
+
     def forward_with_film(self, coords, film):
         x = coords
 
@@ -187,17 +361,23 @@ class PositionalEncoding(nn.Module):
         super().__init__()
         self.in_features = in_features
         self.n_dims = n_dims
+        # Shaped (n_dims, 1) so it broadcasts against x.unsqueeze(-2) directly.
+        self.register_buffer('freqs', (torch.pow(2., torch.arange(n_dims)) * math.pi).unsqueeze(-1), persistent=False)
 
     def out_size(self):
         return self.in_features * self.n_dims * 2
     
     def forward(self, x):
-        y = []
-        for i in range(self.n_dims):
-            y.append(torch.sin(2**i * np.pi * x))
-            y.append(torch.cos(2**i * np.pi * x))
-        
-        return torch.cat(y, dim=-1)
+        # Output layout matches the original per-frequency loop: [sin(f_0 x), cos(f_0 x), sin(f_1 x), ...]
+        xf = x.unsqueeze(-2) * self.freqs
+        if torch.is_grad_enabled() and xf.requires_grad:
+            return torch.stack((xf.sin(), xf.cos()), dim=-2).flatten(-3)
+
+        # out= doesn't support autograd, but without it sin/cos can be written straight into the result.
+        out = xf.new_empty(xf.shape[:-1] + (2, self.in_features))
+        torch.sin(xf, out=out[..., 0, :])
+        torch.cos(xf, out=out[..., 1, :])
+        return out.flatten(-3)
 
 class FullyFusedFC(nn.Module):
     def __init__(self, in_features, out_features, num_hidden_layers, hidden_size, input_encoding='identity', repeat_nested_encoding=False):
@@ -233,4 +413,8 @@ class FullyFusedFC(nn.Module):
 
     def forward(self, x):
         shape = x.shape
-        return self.net(x.reshape(-1, shape[-1])).reshape(shape[0], shape[1], -1).float()
\ No newline at end of file
+        out = self.net(x.contiguous().view(-1, shape[-1])).view(shape[0], shape[1], -1)
+        if torch.is_autocast_enabled():
+            # Half precision output is fine inside an autocast region, skip the extra cast pass.
+            return out
+        return out.float()
\ No newline at end of file
@@ -55,6 +55,9 @@ model = models.LFAutoDecoder(num_instances=num_instances, latent_dim=256, parame
 model.eval()
 print("Loading model")
 model.load_state_dict(state_dict)
+# Only worth it when the Siren runs on its own weights, the scripted sine already fuses omega_0 for predicted ones.
+if opt.network == 'siren' and model.fit_single:
+    model.fuse_omega()
 
 def convert_image(img, type):
     img = img[0]
@@ -14,7 +14,8 @@ import hyperlayers
 
 class LightFieldModel(nn.Module):
     def __init__(self, latent_dim, parameterization='plucker', network='relu',
-                 fit_single=False, tcnn=False, conditioning='hyper', input_encoding='identity', depth=False, alpha=False):
+                 fit_single=False, tcnn=False, conditioning='hyper', input_encoding='identity', depth=False, alpha=False,
+                 amp=False, checkpoint_activations=False):
         super().__init__()
 
         self.latent_dim = latent_dim
@@ -24,6 +25,7 @@ class LightFieldModel(nn.Module):
         self.conditioning = conditioning
         self.depth = depth
         self.alpha = alpha
+        self.amp = amp
 
         out_channels = 3
 
@@ -54,7 +56,7 @@ class LightFieldModel(nn.Module):
                     omega_0 = 30.
                     phi = custom_layers.Siren(in_features=input_encoding_outsize, hidden_features=256, hidden_layers=8,
                                                 out_features=out_channels, outermost_linear=True, hidden_omega_0=omega_0,
-                                                first_omega_0=omega_0)
+                                                first_omega_0=omega_0, checkpoint_activations=checkpoint_activations)
 
                 self.phi = nn.Sequential(
                     input_encoding,
@@ -68,7 +70,7 @@ class LightFieldModel(nn.Module):
                 omega_0 = 30.
                 self.phi = custom_layers.Siren(in_features=6, hidden_features=256, hidden_layers=8,
                                                out_features=out_channels, outermost_linear=True, hidden_omega_0=omega_0,
-                                               first_omega_0=omega_0)
+                                               first_omega_0=omega_0, checkpoint_activations=checkpoint_activations)
         elif conditioning == 'concat':
             self.phi = nn.Sequential(
                 nn.Linear(6+self.latent_dim, self.num_hidden_units_phi),
@@ -97,6 +99,15 @@ class LightFieldModel(nn.Module):
         print(self.phi)
         print(np.sum(np.prod(param.shape) for param in self.phi.parameters()))
 
+    def fuse_omega(self):
+        '''Folds omega_0 of every Siren layer into its weights for faster inference, see SineLayer.fuse_omega.'''
+        if self.conditioning == 'low_rank':
+            # LowRankHyperNetwork multiplies the Siren's own parameters, which would then be scaled twice.
+            raise ValueError('fuse_omega() is not supported with low_rank conditioning.')
+        for module in self.phi.modules():
+            if isinstance(module, custom_layers.Siren):
+                module.fuse_omega()
+
     def get_light_field_function(self, z=None):
         if self.fit_single:
             phi = self.phi
@@ -156,7 +167,10 @@ class LightFieldModel(nn.Module):
         out_dict['lf_function'] = lf_function
 
         if timing: t0 = time.time()
-        lf_out = lf_function(out_dict['coords'])
+        # bfloat16 autocast only covers the light field itself; hypernetwork weights stay in float32.
+        with torch.autocast(device_type=light_field_coords.device.type, dtype=torch.bfloat16, enabled=self.amp):
+            lf_out = lf_function(out_dict['coords'])
+        lf_out = lf_out.float()
         if timing: t1 = time.time(); total_n = t1 - t0; print(f'{total_n}')
 
         rgb = lf_out[..., :3]